@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drfpasswordless', '0005_auto_20201117_0410'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='callbacktoken',
+            index=models.Index(fields=['key', 'is_active', 'type'], name='cbtok_key_active_type_idx'),
+        ),
+    ]
@@ -65,3 +65,7 @@ class CallbackToken(AbstractBaseCallbackToken):
 
     class Meta(AbstractBaseCallbackToken.Meta):
         verbose_name = 'Callback Token'
+        indexes = [
+            # Token lookups always filter on key plus active state and type.
+            models.Index(fields=['key', 'is_active', 'type'], name='cbtok_key_active_type_idx'),
+        ]
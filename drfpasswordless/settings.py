@@ -95,6 +95,10 @@ DEFAULTS = {
     'PASSWORDLESS_EMAIL_CALLBACK': 'drfpasswordless.utils.send_email_with_callback_token',
     'PASSWORDLESS_SMS_CALLBACK': 'drfpasswordless.utils.send_sms_with_callback_token',
 
+    # Celery queues used by the async senders in drfpasswordless.tasks
+    'PASSWORDLESS_EMAIL_QUEUE': 'email_queue',
+    'PASSWORDLESS_SMS_QUEUE': 'sms_queue',
+
     # Token Generation Retry Count
     'PASSWORDLESS_TOKEN_GENERATION_ATTEMPTS': 3,
 
@@ -0,0 +1,88 @@
+"""
+Optional Celery tasks that move token delivery off the request thread.
+
+Requires celery. Enable by pointing the callback settings at the async senders:
+
+    'PASSWORDLESS_EMAIL_CALLBACK': 'drfpasswordless.tasks.send_email_with_callback_token_async',
+    'PASSWORDLESS_SMS_CALLBACK': 'drfpasswordless.tasks.send_sms_with_callback_token_async',
+
+and schedule expire_callback_tokens with celery beat to clean up expired tokens.
+"""
+import logging
+from celery import shared_task
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from drfpasswordless.models import CallbackToken
+from drfpasswordless.settings import api_settings
+from drfpasswordless.utils import (
+    invalidate_expired_tokens,
+    send_email_with_callback_token,
+    send_sms_with_callback_token,
+)
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+
+@shared_task
+def send_email_task(user_id, token_id, **kwargs):
+    try:
+        user = User.objects.get(pk=user_id)
+        token = CallbackToken.objects.get(pk=token_id)
+    except (User.DoesNotExist, CallbackToken.DoesNotExist):
+        logger.warning("drfpasswordless: User or token went away before the token email was sent.")
+        return False
+    return send_email_with_callback_token(user, token, **kwargs)
+
+
+@shared_task
+def send_sms_task(user_id, token_id, **kwargs):
+    try:
+        user = User.objects.get(pk=user_id)
+        token = CallbackToken.objects.get(pk=token_id)
+    except (User.DoesNotExist, CallbackToken.DoesNotExist):
+        logger.warning("drfpasswordless: User or token went away before the token SMS was sent.")
+        return False
+    return send_sms_with_callback_token(user, token, **kwargs)
+
+
+def send_email_with_callback_token_async(user, email_token, **kwargs):
+    """
+    Queues the token email on PASSWORDLESS_EMAIL_QUEUE.
+
+    Only reports whether the email was queued, not whether it was delivered.
+    """
+    if not api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS:
+        logger.debug("Failed to send token email. Missing PASSWORDLESS_EMAIL_NOREPLY_ADDRESS.")
+        return False
+
+    # Dispatch after commit so the worker can see the token row.
+    args = (user.pk, str(email_token.pk))
+    queue = api_settings.PASSWORDLESS_EMAIL_QUEUE
+    transaction.on_commit(lambda: send_email_task.apply_async(args=args, kwargs=kwargs, queue=queue))
+    return True
+
+
+def send_sms_with_callback_token_async(user, mobile_token, **kwargs):
+    """
+    Queues the token SMS on PASSWORDLESS_SMS_QUEUE.
+
+    Only reports whether the SMS was queued, not whether it was delivered.
+    """
+    if api_settings.PASSWORDLESS_MOBILE_NOREPLY_NUMBER is None:
+        logger.debug("Failed to send token SMS. Missing PASSWORDLESS_MOBILE_NOREPLY_NUMBER.")
+        return False
+
+    # Dispatch after commit so the worker can see the token row.
+    args = (user.pk, str(mobile_token.pk))
+    queue = api_settings.PASSWORDLESS_SMS_QUEUE
+    transaction.on_commit(lambda: send_sms_task.apply_async(args=args, kwargs=kwargs, queue=queue))
+    return True
+
+
+@shared_task
+def expire_callback_tokens():
+    """
+    Bulk-invalidates expired callback tokens. Meant to run periodically on celery beat.
+    """
+    return invalidate_expired_tokens()
@@ -1,37 +1,61 @@
+import asyncio
 import logging
 import requests
 import os
-import json
-from django.contrib.auth import get_user_model
+import weakref
+from datetime import timedelta
 from django.core.exceptions import PermissionDenied
 from django.core.mail import send_mail
-from django.template import loader
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import get_template
 from django.utils import timezone
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from rest_framework.authtoken.models import Token
 from drfpasswordless.models import CallbackToken
 from drfpasswordless.settings import api_settings
 
 
 logger = logging.getLogger(__name__)
-User = get_user_model()
+
+# Shared session so recaptcha verifications reuse pooled TCP/TLS connections.
+_captcha_session = requests.Session()
+_captcha_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=50,
+                                               # read=0: an assessment may have gone through before
+                                               # its response timed out, and tokens can't be reassessed.
+                                               max_retries=Retry(total=1, read=0, backoff_factor=0.2,
+                                                                 status_forcelist=[502, 503, 504],
+                                                                 allowed_methods={'POST'},
+                                                                 raise_on_status=False)))
+# (connect, read) timeouts in seconds so a slow recaptcha endpoint can't pin a worker.
+_CAPTCHA_TIMEOUT = (1.0, 2.5)
+
+# One httpx AsyncClient per event loop, since a client can't be shared across loops.
+# Entries are dropped when their loop is garbage collected but the client is not closed,
+# so callers must await aclose_captcha_client() on each loop they verify from.
+_captcha_async_clients = weakref.WeakKeyDictionary()
+_twilio_client = None
+_email_template_cache = {}
+_TWILIO_SERVICE = os.environ.get('TWILIO_SERVICE')
 
 
 def authenticate_by_token(callback_token):
     try:
-        token = CallbackToken.objects.get(key=callback_token, is_active=True, type=CallbackToken.TOKEN_TYPE_AUTH)
+        token = CallbackToken.objects.select_related('user').only('id', 'user', 'is_active') \
+            .get(key=callback_token, is_active=True, type=CallbackToken.TOKEN_TYPE_AUTH)
 
-        # Returning a user designates a successful authentication.
-        token.user = User.objects.get(pk=token.user.pk)
-        token.is_active = False  # Mark this token as used.
-        token.save()
+        # Mark this token as used. Only one of several concurrent requests can flip it.
+        if CallbackToken.objects.filter(pk=token.pk, is_active=True).update(is_active=False) != 1:
+            logger.debug("drfpasswordless: Callback token was already used.")
+            return None
 
+        # Returning a user designates a successful authentication.
         return token.user
 
     except CallbackToken.DoesNotExist:
         logger.debug("drfpasswordless: Challenged with a callback token that doesn't exist.")
-    except User.DoesNotExist:
-        logger.debug("drfpasswordless: Authenticated user somehow doesn't exist.")
     except PermissionDenied:
         logger.debug("drfpasswordless: Permission denied while authenticating.")
 
@@ -39,31 +63,25 @@ def authenticate_by_token(callback_token):
 
 
 def create_callback_token_for_user(user, alias_type, token_type):
-    token = None
     alias_type_u = alias_type.upper()
-    to_alias_field = getattr(api_settings, f'PASSWORDLESS_USER_{alias_type_u}_FIELD_NAME')
-    if user.pk in api_settings.PASSWORDLESS_DEMO_USERS.keys():
-        token = CallbackToken.objects.filter(user=user).first()
-        if token:
-            return token
-        else:
-            return CallbackToken.objects.create(
-                user=user,
-                key=api_settings.PASSWORDLESS_DEMO_USERS[user.pk],
-                to_alias_type=alias_type_u,
-                to_alias=getattr(user, to_alias_field),
-                type=token_type
-            )
-    
-    token = CallbackToken.objects.create(user=user,
-                                            to_alias_type=alias_type_u,
-                                            to_alias=getattr(user, to_alias_field),
-                                            type=token_type)
-
-    if token is not None:
+    to_alias = getattr(user, getattr(api_settings, f'PASSWORDLESS_USER_{alias_type_u}_FIELD_NAME'))
+    demo_key = api_settings.PASSWORDLESS_DEMO_USERS.get(user.pk)
+    if demo_key is not None:
+        # Match on the demo key and type so older tokens the user holds don't get in the way.
+        token, _ = CallbackToken.objects.get_or_create(user=user, key=demo_key, type=token_type, defaults={
+            'to_alias_type': alias_type_u,
+            'to_alias': to_alias,
+        })
         return token
 
-    return None
+    return CallbackToken.objects.create(user=user,
+                                        to_alias_type=alias_type_u,
+                                        to_alias=to_alias,
+                                        type=token_type)
+
+
+def _token_expiry_cutoff():
+    return timezone.now() - timedelta(seconds=api_settings.PASSWORDLESS_TOKEN_EXPIRE_TIME)
 
 
 def validate_token_age(callback_token):
@@ -71,38 +89,46 @@ def validate_token_age(callback_token):
     Returns True if a given token is within the age expiration limit.
     """
 
-    try:
-        token = CallbackToken.objects.get(key=callback_token, is_active=True)
-        seconds = (timezone.now() - token.created_at).total_seconds()
-        token_expiry_time = api_settings.PASSWORDLESS_TOKEN_EXPIRE_TIME
-        if token.user.pk in api_settings.PASSWORDLESS_DEMO_USERS.keys():
-            return True
-        if seconds <= token_expiry_time:
-            return True
-        else:
-            # Invalidate our token.
-            token.is_active = False
-            token.save()
-            return False
-
-    except CallbackToken.DoesNotExist:
+    token = CallbackToken.objects.filter(key=callback_token, is_active=True).values('user_id', 'created_at').first()
+    if token is None:
         # No valid token.
         return False
 
+    if token['user_id'] in api_settings.PASSWORDLESS_DEMO_USERS:
+        return True
+
+    # Expired tokens are deactivated in bulk by invalidate_expired_tokens.
+    return token['created_at'] >= _token_expiry_cutoff()
+
+
+def invalidate_expired_tokens():
+    """
+    Deactivates every active token older than the expiration limit.
+    Returns the number of tokens invalidated.
+    """
+    return CallbackToken.objects.active() \
+        .filter(created_at__lt=_token_expiry_cutoff()) \
+        .exclude(user_id__in=api_settings.PASSWORDLESS_DEMO_USERS) \
+        .update(is_active=False)
+
 
 def verify_user_alias(user, token):
     """
     Marks a user's contact point as verified depending on accepted token type.
     """
-    if token.to_alias_type == 'EMAIL':
-        if token.to_alias == getattr(user, api_settings.PASSWORDLESS_USER_EMAIL_FIELD_NAME):
-            setattr(user, api_settings.PASSWORDLESS_USER_EMAIL_VERIFIED_FIELD_NAME, True)
-    elif token.to_alias_type == 'MOBILE':
-        if token.to_alias == getattr(user, api_settings.PASSWORDLESS_USER_MOBILE_FIELD_NAME):
-            setattr(user, api_settings.PASSWORDLESS_USER_MOBILE_VERIFIED_FIELD_NAME, True)
-    else:
+    alias_fields = {
+        'EMAIL': (api_settings.PASSWORDLESS_USER_EMAIL_FIELD_NAME,
+                  api_settings.PASSWORDLESS_USER_EMAIL_VERIFIED_FIELD_NAME),
+        'MOBILE': (api_settings.PASSWORDLESS_USER_MOBILE_FIELD_NAME,
+                   api_settings.PASSWORDLESS_USER_MOBILE_VERIFIED_FIELD_NAME),
+    }.get(token.to_alias_type)
+    if alias_fields is None:
         return False
-    user.save()
+
+    alias_field, verified_field = alias_fields
+    if token.to_alias == getattr(user, alias_field):
+        setattr(user, verified_field, True)
+        user.save(update_fields=[verified_field])
     return True
 
 
@@ -115,6 +141,25 @@ def inject_template_context(context):
     return context
 
 
+def _get_email_template(template_name):
+    """
+    Returns the compiled email template, resolving it through the loaders only once.
+    Skipped under DEBUG so edited templates are picked up without a restart.
+    """
+    if settings.DEBUG:
+        return get_template(template_name)
+    template = _email_template_cache.get(template_name)
+    if template is None:
+        template = _email_template_cache.setdefault(template_name, get_template(template_name))
+    return template
+
+
+@receiver(setting_changed)
+def clear_email_template_cache(setting, **kwargs):
+    if setting == 'TEMPLATES':
+        _email_template_cache.clear()
+
+
 def send_email_with_callback_token(user, email_token, **kwargs):
     """
     Sends a Email to user.email.
@@ -122,8 +167,10 @@ def send_email_with_callback_token(user, email_token, **kwargs):
     Passes silently without sending in test environment
     """
 
+    email_field = api_settings.PASSWORDLESS_USER_EMAIL_FIELD_NAME
+    noreply_address = api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS
     try:
-        if api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS:
+        if noreply_address:
             # Make sure we have a sending address before sending.
 
             # Get email subject and message
@@ -136,12 +183,12 @@ def send_email_with_callback_token(user, email_token, **kwargs):
 
             # Inject context if user specifies.
             context = inject_template_context({'callback_token': email_token.key, })
-            html_message = loader.render_to_string(email_html, context,)
+            html_message = _get_email_template(email_html).render(context)
             send_mail(
                 email_subject,
                 email_plaintext % email_token.key,
-                api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS,
-                [getattr(user, api_settings.PASSWORDLESS_USER_EMAIL_FIELD_NAME)],
+                noreply_address,
+                [getattr(user, email_field)],
                 fail_silently=False,
                 html_message=html_message,)
 
@@ -153,11 +200,32 @@ def send_email_with_callback_token(user, email_token, **kwargs):
     except Exception as e:
         logger.debug("Failed to send token email to user: %d.\n"
                   "Possibly no email on user object. Email entered was %s" %
-                  (user.id, getattr(user, api_settings.PASSWORDLESS_USER_EMAIL_FIELD_NAME)))
+                  (user.id, getattr(user, email_field)))
         logger.debug(e)
         return False
 
 
+def _get_twilio_client():
+    """
+    Lazily builds a single Twilio client so its HTTP session is reused across sends.
+    """
+    global _twilio_client
+    if _twilio_client is None:
+        from twilio.rest import Client
+        _twilio_client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+    return _twilio_client
+
+
+def _get_mobile_number(user):
+    """
+    Returns the user's mobile as a string, e.g. converting a phonenumber_field PhoneNumber.
+    """
+    to_number = getattr(user, api_settings.PASSWORDLESS_USER_MOBILE_FIELD_NAME)
+    if not isinstance(to_number, str):
+        to_number = str(to_number)
+    return to_number
+
+
 def send_sms_with_callback_token(user, mobile_token, **kwargs):
     """
     Sends a SMS to user.mobile via Twilio Verify.
@@ -176,12 +244,9 @@ def send_sms_with_callback_token(user, mobile_token, **kwargs):
     base_string = kwargs.get('mobile_message', api_settings.PASSWORDLESS_MOBILE_MESSAGE)
 
     try:
-        from twilio.rest import Client
-        twilio_client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        twilio_client = _get_twilio_client()
 
-        to_number = getattr(user, api_settings.PASSWORDLESS_USER_MOBILE_FIELD_NAME)
-        if to_number.__class__.__name__ == 'PhoneNumber':
-            to_number = to_number.__str__()
+        to_number = _get_mobile_number(user)
 
         twilio_client.messages.create(
                 body=base_string % mobile_token.key,
@@ -204,14 +269,15 @@ def send_sms_with_callback_token(user, mobile_token, **kwargs):
         return False
     
 def validate_twilio_token(user, token):
+    if _TWILIO_SERVICE is None:
+        logger.debug("Couldn't validate SMS token. Did you set TWILIO_SERVICE?")
+        return False
+    to_number = None
     try:
-        from twilio.rest import Client
-        twilio_client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-        to_number = getattr(user, api_settings.PASSWORDLESS_USER_MOBILE_FIELD_NAME)
-        if to_number.__class__.__name__ == 'PhoneNumber':
-            to_number = to_number.__str__()
+        to_number = _get_mobile_number(user)
+        twilio_client = _get_twilio_client()
         verification_check = twilio_client.verify \
-            .services(os.environ['TWILIO_SERVICE']) \
+            .services(_TWILIO_SERVICE) \
             .verification_checks \
             .create(to=to_number, code=token)
         return verification_check.status == 'approved'
@@ -223,18 +289,89 @@ def validate_twilio_token(user, token):
 
 def create_authentication_token(user):
     """ Default way to create an authentication token"""
-    return Token.objects.get_or_create(user=user)
+    try:
+        # Most users already have a token, so skip get_or_create's savepoint.
+        return Token.objects.get(user=user), False
+    except Token.DoesNotExist:
+        # get_or_create handles a concurrent first login creating the token first.
+        return Token.objects.get_or_create(user=user)
 
-def verify_captcha(token):
-    payload = {
+def _captcha_url():
+    return (f"https://recaptchaenterprise.googleapis.com/v1/projects/{settings.GCLOUD_PROJECT_ID}"
+            f"/assessments?key={settings.GCLOUD_API_KEY}")
+
+
+def _captcha_payload(token):
+    return {
         "event": {
             "token": token,
             "siteKey": settings.RECAPTCHA_KEY,
             "expectedAction": "login"
         }
     }
-    headers = {
-        'Content-Type': 'application/json; charset=utf-8'
-    }
-    r = requests.post(f"https://recaptchaenterprise.googleapis.com/v1/projects/{settings.GCLOUD_PROJECT_ID}/assessments?key={settings.GCLOUD_API_KEY}", headers=headers, data=json.dumps(payload))
-    return r.status_code == 200 and r.json()['tokenProperties']['valid'] and r.json()['riskAnalysis']['score'] > api_settings.PASSWORDLESS_RECAPTCHA_THRESHOLD
+
+
+def _captcha_passed(response):
+    if response.status_code != 200:
+        # Error responses aren't guaranteed to be JSON, so don't parse them.
+        return False
+    body = response.json()
+    return (body['tokenProperties']['valid']
+            and body['riskAnalysis']['score'] > api_settings.PASSWORDLESS_RECAPTCHA_THRESHOLD)
+
+
+def verify_captcha(token):
+    try:
+        r = _captcha_session.post(_captcha_url(), json=_captcha_payload(token), timeout=_CAPTCHA_TIMEOUT)
+    except requests.RequestException as e:
+        logger.debug("drfpasswordless: Captcha verification request failed.")
+        logger.debug(e)
+        return False
+    return _captcha_passed(r)
+
+
+def _get_captcha_async_client():
+    """
+    Returns the running loop's httpx AsyncClient so its verifications share one HTTP/2 connection.
+    """
+    loop = asyncio.get_running_loop()
+    client = _captcha_async_clients.get(loop)
+    if client is None:
+        import httpx
+        connect_timeout, read_timeout = _CAPTCHA_TIMEOUT
+        client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_connections=100),
+                                   timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        _captcha_async_clients[loop] = client
+    return client
+
+
+async def aclose_captcha_client():
+    """
+    Closes the running loop's captcha client, e.g. from an ASGI lifespan shutdown handler.
+    Must be awaited on every event loop that called averify_captcha(s) before that loop closes.
+    """
+    client = _captcha_async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def averify_captcha(token):
+    """
+    Async version of verify_captcha for ASGI callers. Requires httpx (with the http2 extra).
+    """
+    import httpx
+    try:
+        r = await _get_captcha_async_client().post(_captcha_url(), json=_captcha_payload(token))
+    except httpx.HTTPError as e:
+        logger.debug("drfpasswordless: Captcha verification request failed.")
+        logger.debug(e)
+        return False
+    return _captcha_passed(r)
+
+
+async def averify_captchas(tokens):
+    """
+    Verifies a batch of captcha tokens concurrently over the shared async client.
+    Returns a list of booleans in the same order as tokens.
+    """
+    return list(await asyncio.gather(*(averify_captcha(token) for token in tokens)))
@@ -26,9 +26,17 @@ VERSION = None
 
 # What packages are required for this module to be executed?
 REQUIRED = [
-    'Django', 'djangorestframework'
+    'Django', 'djangorestframework', 'requests',
+    # Retry(allowed_methods=...) needs urllib3 1.26+.
+    'urllib3>=1.26',
 ]
 
+# What packages are optional?
+EXTRAS = {
+    'async': ['httpx[http2]'],
+    'celery': ['celery'],
+}
+
 # The rest you shouldn't have to touch too much :)
 # ------------------------------------------------
 # Except, perhaps the License and Trove Classifiers!
@@ -99,6 +107,7 @@ setup(
     url=URL,
     packages=find_packages(exclude=('tests',)),
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
     include_package_data=True,
     license='MIT',
     classifiers=[
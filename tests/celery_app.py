@@ -0,0 +1,5 @@
+from celery import Celery
+
+# Test-only Celery app that reads CELERY_* settings, e.g. CELERY_TASK_ALWAYS_EAGER.
+app = Celery('tests')
+app.config_from_object('django.conf:settings', namespace='CELERY')
@@ -53,6 +53,7 @@ def pytest_configure():
             'django.contrib.auth.hashers.MD5PasswordHasher',
         ),
         AUTH_USER_MODEL='tests.CustomUser',
+        CELERY_TASK_ALWAYS_EAGER=True,
     )
 
     try:
@@ -0,0 +1,87 @@
+import unittest
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.db import transaction
+from django.test import TransactionTestCase
+from drfpasswordless.settings import api_settings, DEFAULTS
+from drfpasswordless.utils import create_callback_token_for_user, CallbackToken
+
+try:
+    import celery
+except ImportError:
+    celery = None
+
+User = get_user_model()
+
+
+@unittest.skipIf(celery is None, 'celery is not installed')
+class AsyncEmailCallbackTests(TransactionTestCase):
+    """
+    Runs the Celery senders eagerly (CELERY_TASK_ALWAYS_EAGER) to check dispatch happens after commit.
+    """
+
+    def setUp(self):
+        import tests.celery_app  # noqa: F401
+        api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS = 'noreply@example.com'
+        self.user = User.objects.create(email='aaron@example.com')
+
+    def test_email_sent_after_commit(self):
+        from drfpasswordless.tasks import send_email_with_callback_token_async
+
+        with transaction.atomic():
+            token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+            self.assertTrue(send_email_with_callback_token_async(self.user, token))
+            # Nothing is dispatched while the token row is uncommitted.
+            self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['aaron@example.com'])
+        self.assertIn(token.key, mail.outbox[0].body)
+
+    def test_email_not_queued_without_noreply_address(self):
+        from drfpasswordless.tasks import send_email_with_callback_token_async
+
+        api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS = None
+        token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        self.assertFalse(send_email_with_callback_token_async(self.user, token))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def tearDown(self):
+        api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS = DEFAULTS['PASSWORDLESS_EMAIL_NOREPLY_ADDRESS']
+
+
+@unittest.skipIf(celery is None, 'celery is not installed')
+class AsyncSMSCallbackTests(TransactionTestCase):
+    """
+    Runs the Celery SMS sender eagerly with the Twilio send mocked out.
+    """
+
+    def setUp(self):
+        import tests.celery_app  # noqa: F401
+        api_settings.PASSWORDLESS_MOBILE_NOREPLY_NUMBER = '+15550000000'
+        self.user = User.objects.create(mobile='+15551234567')
+
+    def test_sms_sent_after_commit(self):
+        from drfpasswordless.tasks import send_sms_with_callback_token_async
+
+        with mock.patch('drfpasswordless.tasks.send_sms_with_callback_token', return_value=True) as send_sms:
+            with transaction.atomic():
+                token = create_callback_token_for_user(self.user, 'mobile', CallbackToken.TOKEN_TYPE_AUTH)
+                self.assertTrue(send_sms_with_callback_token_async(self.user, token, mobile_message='Code: %s'))
+                # Nothing is dispatched while the token row is uncommitted.
+                send_sms.assert_not_called()
+
+        send_sms.assert_called_once_with(self.user, token, mobile_message='Code: %s')
+
+    def test_sms_not_queued_without_noreply_number(self):
+        from drfpasswordless.tasks import send_sms_with_callback_token_async
+
+        api_settings.PASSWORDLESS_MOBILE_NOREPLY_NUMBER = None
+        token = create_callback_token_for_user(self.user, 'mobile', CallbackToken.TOKEN_TYPE_AUTH)
+        with mock.patch('drfpasswordless.tasks.send_sms_with_callback_token') as send_sms:
+            self.assertFalse(send_sms_with_callback_token_async(self.user, token))
+        send_sms.assert_not_called()
+
+    def tearDown(self):
+        api_settings.PASSWORDLESS_MOBILE_NOREPLY_NUMBER = DEFAULTS['PASSWORDLESS_MOBILE_NOREPLY_NUMBER']
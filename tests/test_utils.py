@@ -0,0 +1,344 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest import mock
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from drfpasswordless.settings import api_settings, DEFAULTS
+from drfpasswordless.utils import (
+    authenticate_by_token,
+    create_callback_token_for_user,
+    inject_template_context,
+    invalidate_expired_tokens,
+    send_email_with_callback_token,
+    validate_token_age,
+    CallbackToken,
+)
+from drfpasswordless import utils
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+User = get_user_model()
+
+
+class AuthenticateByTokenTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='aaron@example.com')
+        self.token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+
+    def test_authenticate(self):
+        # One joined SELECT for token and user, one UPDATE to spend the token.
+        with self.assertNumQueries(2):
+            user = authenticate_by_token(self.token.key)
+            self.assertEqual(user, self.user)
+            self.assertEqual(user.email, 'aaron@example.com')
+        self.assertFalse(CallbackToken.objects.get(pk=self.token.pk).is_active)
+
+    def test_token_spent_once(self):
+        self.assertEqual(authenticate_by_token(self.token.key), self.user)
+        self.assertIsNone(authenticate_by_token(self.token.key))
+
+    def test_token_spent_concurrently(self):
+        # Another request deactivated the token between our SELECT and UPDATE.
+        with mock.patch.object(QuerySet, 'update', return_value=0):
+            self.assertIsNone(authenticate_by_token(self.token.key))
+
+    def test_verify_token_rejected(self):
+        token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_VERIFY)
+        self.assertIsNone(authenticate_by_token(token.key))
+
+
+class AliasFieldSettingsTests(TestCase):
+    """
+    Alias field names are read per call, so runtime overrides of api_settings take effect.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='aaron@example.com', mobile='+15551234567')
+
+    def test_email_field_name_override(self):
+        token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        self.assertEqual(token.to_alias, 'aaron@example.com')
+
+        api_settings.PASSWORDLESS_USER_EMAIL_FIELD_NAME = 'mobile'
+        token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        self.assertEqual(token.to_alias, '+15551234567')
+
+    def tearDown(self):
+        api_settings.PASSWORDLESS_USER_EMAIL_FIELD_NAME = DEFAULTS['PASSWORDLESS_USER_EMAIL_FIELD_NAME']
+
+
+class TemplateContextTests(TestCase):
+
+    def test_no_context_processors(self):
+        self.assertEqual(inject_template_context({'callback_token': '123456'}), {'callback_token': '123456'})
+
+    def test_context_processors_override(self):
+        inject_template_context({})
+        api_settings.PASSWORDLESS_CONTEXT_PROCESSORS = [lambda: {'site': 'example.com'}]
+        self.assertEqual(inject_template_context({'callback_token': '123456'}),
+                         {'callback_token': '123456', 'site': 'example.com'})
+
+    def tearDown(self):
+        api_settings.PASSWORDLESS_CONTEXT_PROCESSORS = DEFAULTS['PASSWORDLESS_CONTEXT_PROCESSORS']
+
+
+class DemoUserTokenTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='aaron@example.com', mobile='+15551234567')
+
+    def test_demo_user_gets_static_token(self):
+        api_settings.PASSWORDLESS_DEMO_USERS = {self.user.pk: '123456'}
+        token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        self.assertEqual(token.key, '123456')
+        self.assertEqual(create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH), token)
+
+    def test_demo_user_with_existing_tokens(self):
+        # Tokens issued before the user was added to PASSWORDLESS_DEMO_USERS.
+        create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        create_callback_token_for_user(self.user, 'mobile', CallbackToken.TOKEN_TYPE_VERIFY)
+        self.assertEqual(CallbackToken.objects.filter(user=self.user).count(), 2)
+
+        api_settings.PASSWORDLESS_DEMO_USERS = {self.user.pk: '123456'}
+        token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        self.assertEqual(token.user, self.user)
+        self.assertEqual(token.key, '123456')
+        self.assertEqual(create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH), token)
+
+    def test_demo_user_key_shared_across_token_types(self):
+        api_settings.PASSWORDLESS_DEMO_USERS = {self.user.pk: '123456'}
+        auth_token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        verify_token = create_callback_token_for_user(self.user, 'mobile', CallbackToken.TOKEN_TYPE_VERIFY)
+        self.assertNotEqual(auth_token, verify_token)
+        self.assertEqual(verify_token.key, '123456')
+        self.assertEqual(create_callback_token_for_user(self.user, 'mobile', CallbackToken.TOKEN_TYPE_VERIFY),
+                         verify_token)
+
+    def tearDown(self):
+        api_settings.PASSWORDLESS_DEMO_USERS = DEFAULTS['PASSWORDLESS_DEMO_USERS']
+
+
+class TokenExpiryTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='aaron@example.com')
+        self.demo_user = User.objects.create(email='demo@example.com')
+
+    def create_expired_token(self, user):
+        token = create_callback_token_for_user(user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        expired_at = timezone.now() - timedelta(seconds=api_settings.PASSWORDLESS_TOKEN_EXPIRE_TIME + 1)
+        CallbackToken.objects.filter(pk=token.pk).update(created_at=expired_at)
+        return token
+
+    def test_fresh_token_is_valid(self):
+        token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        self.assertTrue(validate_token_age(token.key))
+
+    def test_expired_token_fails_without_write(self):
+        token = self.create_expired_token(self.user)
+        with self.assertNumQueries(1):
+            self.assertFalse(validate_token_age(token.key))
+        self.assertTrue(CallbackToken.objects.get(pk=token.pk).is_active)
+
+    def test_invalidate_expired_tokens(self):
+        expired = self.create_expired_token(self.user)
+        api_settings.PASSWORDLESS_DEMO_USERS = {self.demo_user.pk: '123456'}
+        demo = self.create_expired_token(self.demo_user)
+        fresh_user = User.objects.create(email='fresh@example.com')
+        fresh = create_callback_token_for_user(fresh_user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+
+        self.assertEqual(invalidate_expired_tokens(), 1)
+        self.assertFalse(CallbackToken.objects.get(pk=expired.pk).is_active)
+        self.assertTrue(CallbackToken.objects.get(pk=demo.pk).is_active)
+        self.assertTrue(CallbackToken.objects.get(pk=fresh.pk).is_active)
+        self.assertTrue(validate_token_age(demo.key))
+
+    def tearDown(self):
+        api_settings.PASSWORDLESS_DEMO_USERS = DEFAULTS['PASSWORDLESS_DEMO_USERS']
+
+
+class EmailTemplateTests(TestCase):
+
+    def setUp(self):
+        api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS = 'noreply@example.com'
+        self.user = User.objects.create(email='aaron@example.com')
+        self.token = create_callback_token_for_user(self.user, 'email', CallbackToken.TOKEN_TYPE_AUTH)
+        self.template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.template_dir)
+        self.addCleanup(utils._email_template_cache.clear)
+
+    def write_template(self, content):
+        with open(os.path.join(self.template_dir, 'token_email.html'), 'w') as f:
+            f.write(content)
+
+    def templates(self):
+        return [dict(settings.TEMPLATES[0], DIRS=[self.template_dir])]
+
+    def send(self):
+        self.assertTrue(send_email_with_callback_token(self.user, self.token, email_html='token_email.html'))
+        return mail.outbox[-1].alternatives[0][0]
+
+    def test_default_template(self):
+        self.assertTrue(send_email_with_callback_token(self.user, self.token))
+        self.assertIn(self.token.key, mail.outbox[0].alternatives[0][0])
+        self.assertIn(self.token.key, mail.outbox[0].body)
+
+    def test_template_cached(self):
+        self.write_template('first {{ callback_token }}')
+        with override_settings(TEMPLATES=self.templates()):
+            self.assertEqual(self.send(), 'first ' + self.token.key)
+            self.write_template('second {{ callback_token }}')
+            self.assertEqual(self.send(), 'first ' + self.token.key)
+
+    def test_templates_setting_change_clears_cache(self):
+        self.write_template('first {{ callback_token }}')
+        with override_settings(TEMPLATES=self.templates()):
+            self.assertEqual(self.send(), 'first ' + self.token.key)
+        self.write_template('second {{ callback_token }}')
+        with override_settings(TEMPLATES=self.templates()):
+            self.assertEqual(self.send(), 'second ' + self.token.key)
+
+    def test_template_not_cached_under_debug(self):
+        # Leave reloading to Django's loaders, here an uncached filesystem loader.
+        templates = [dict(self.templates()[0], APP_DIRS=False,
+                          OPTIONS={'loaders': ['django.template.loaders.filesystem.Loader']})]
+        self.write_template('first {{ callback_token }}')
+        with override_settings(TEMPLATES=templates, DEBUG=True):
+            self.assertEqual(self.send(), 'first ' + self.token.key)
+            self.write_template('second {{ callback_token }}')
+            self.assertEqual(self.send(), 'second ' + self.token.key)
+
+    def tearDown(self):
+        api_settings.PASSWORDLESS_EMAIL_NOREPLY_ADDRESS = DEFAULTS['PASSWORDLESS_EMAIL_NOREPLY_ADDRESS']
+
+
+@override_settings(RECAPTCHA_KEY='site-key', GCLOUD_PROJECT_ID='project', GCLOUD_API_KEY='api-key')
+class CaptchaTests(TestCase):
+    """
+    Runs verify_captcha, the path the captcha-gated serializers call, against a mocked session.
+    """
+
+    def mock_response(self, status_code=200, valid=True, score=0.9):
+        response = mock.Mock(status_code=status_code)
+        response.json.return_value = {'tokenProperties': {'valid': valid}, 'riskAnalysis': {'score': score}}
+        return response
+
+    def test_valid_captcha(self):
+        with mock.patch.object(utils._captcha_session, 'post', return_value=self.mock_response()) as post:
+            self.assertTrue(utils.verify_captcha('good'))
+        post.assert_called_once_with(
+            'https://recaptchaenterprise.googleapis.com/v1/projects/project/assessments?key=api-key',
+            json={'event': {'token': 'good', 'siteKey': 'site-key', 'expectedAction': 'login'}},
+            timeout=(1.0, 2.5),
+        )
+
+    def test_invalid_captcha(self):
+        for response in [self.mock_response(valid=False), self.mock_response(score=0)]:
+            with mock.patch.object(utils._captcha_session, 'post', return_value=response):
+                self.assertFalse(utils.verify_captcha('bad'))
+
+    def test_error_response_not_parsed(self):
+        response = self.mock_response(status_code=503)
+        with mock.patch.object(utils._captcha_session, 'post', return_value=response):
+            self.assertFalse(utils.verify_captcha('down'))
+        response.json.assert_not_called()
+
+    def test_request_exception(self):
+        with mock.patch.object(utils._captcha_session, 'post', side_effect=requests.Timeout):
+            self.assertFalse(utils.verify_captcha('slow'))
+
+    def test_read_errors_not_retried(self):
+        retries = utils._captcha_session.get_adapter('https://recaptchaenterprise.googleapis.com').max_retries
+        self.assertEqual(retries.read, 0)
+
+
+@unittest.skipIf(httpx is None, 'httpx is not installed')
+@override_settings(RECAPTCHA_KEY='site-key', GCLOUD_PROJECT_ID='project', GCLOUD_API_KEY='api-key')
+class AsyncCaptchaTests(TestCase):
+    """
+    Runs the async captcha helpers against an httpx MockTransport.
+    """
+
+    def setUp(self):
+        self.requests = []
+        self.responses = {}
+        real_client = httpx.AsyncClient
+
+        def handler(request):
+            self.requests.append(request)
+            token = json.loads(request.content)['event']['token']
+            response = self.responses.get(token, httpx.Response(200, json={
+                'tokenProperties': {'valid': True},
+                'riskAnalysis': {'score': 0.9},
+            }))
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        def mock_client(**kwargs):
+            return real_client(transport=httpx.MockTransport(handler), **kwargs)
+
+        patcher = mock.patch('httpx.AsyncClient', side_effect=mock_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_async(self, coro_fn, *args):
+        async def run():
+            try:
+                return await coro_fn(*args)
+            finally:
+                await utils.aclose_captcha_client()
+        return asyncio.run(run())
+
+    def test_valid_captcha(self):
+        self.assertTrue(self.run_async(utils.averify_captcha, 'good'))
+        self.assertEqual(str(self.requests[0].url),
+                         'https://recaptchaenterprise.googleapis.com/v1/projects/project/assessments?key=api-key')
+
+    def test_error_response(self):
+        self.responses['bad'] = httpx.Response(503, text='Service Unavailable')
+        self.assertFalse(self.run_async(utils.averify_captcha, 'bad'))
+
+    def test_transport_error(self):
+        self.responses['slow'] = httpx.ConnectTimeout('timed out')
+        self.assertFalse(self.run_async(utils.averify_captcha, 'slow'))
+
+    def test_batch_preserves_order(self):
+        self.responses['bad'] = httpx.Response(200, json={
+            'tokenProperties': {'valid': False},
+            'riskAnalysis': {'score': 0.9},
+        })
+        self.responses['down'] = httpx.Response(503, text='Service Unavailable')
+        results = self.run_async(utils.averify_captchas, ['good', 'bad', 'down', 'also-good'])
+        self.assertEqual(results, [True, False, False, True])
+        self.assertEqual(len(self.requests), 4)
+
+    def test_client_per_event_loop(self):
+        # Separate event loops, as with async_to_sync or per-test loops, must each get a working client.
+        self.assertTrue(self.run_async(utils.averify_captcha, 'first'))
+        self.assertTrue(self.run_async(utils.averify_captcha, 'second'))
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(len(utils._captcha_async_clients), 0)
+
+    def test_aclose_captcha_client(self):
+        async def run():
+            client = utils._get_captcha_async_client()
+            await utils.aclose_captcha_client()
+            return client.is_closed, utils._get_captcha_async_client() is client
+        is_closed, reused = asyncio.run(run())
+        self.assertTrue(is_closed)
+        self.assertFalse(reused)